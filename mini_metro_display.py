@@ -1,7 +1,23 @@
 import os
 import sys
-from PyQt5.QtCore import QTimer, Qt, pyqtSignal, QThread
-from PyQt5.QtGui import QPainter, QPainterPath, QColor, QFont, QPixmap
+from datetime import datetime, timedelta
+from PyQt5.QtCore import (
+    QTimer,
+    Qt,
+    pyqtSignal,
+    QThread,
+    QMutex,
+    QWaitCondition,
+)
+from PyQt5.QtGui import (
+    QPainter,
+    QPainterPath,
+    QColor,
+    QFont,
+    QImage,
+    QPixmap,
+    QPixmapCache,
+)
 from PyQt5.QtWidgets import (
     QApplication,
     QWidget,
@@ -24,61 +40,118 @@ from utils import (
 
 PAGE_TURN_INTERVAL_SEC = 15
 DISPLAY_UPDATE_INTERVAL_SEC = 120
-UPDATE_INTERVALS_TO_USE_CACHED_STOP_DATA = 30
+STOPS_CACHE_TTL_MIN = int(os.getenv("STOPS_CACHE_TTL_MIN", "60"))
 
 
 class WorkerThread(QThread):
     def __init__(
         self,
         transitland_api_key: str,
-        monitored_stop_list: list[dict],
-        address_coords: tuple[float, float],
+        starting_address: str,
+        monitored_stop_list: list[dict] = None,
+        address_coords: tuple[float, float] = None,
     ):
         super(WorkerThread, self).__init__()
         self.transitland_api_key = transitland_api_key
-        self.monitored_stop_list = (
-            monitored_stop_list  # initial stop list brought over from main
-        )
+        self.starting_address = starting_address
+        # Looked up on the worker thread when not supplied so the UI can show right away
+        self.monitored_stop_list = monitored_stop_list
         self.address_coords = address_coords
-        self.update_intervals_to_use_cached_stop_data = (
-            UPDATE_INTERVALS_TO_USE_CACHED_STOP_DATA
+        self.stops_cache_expiry = datetime.now() + timedelta(
+            minutes=STOPS_CACHE_TTL_MIN
         )
 
+        # Used to sleep between updates in a way stop() can interrupt
+        self._running = True
+        self._mutex = QMutex()
+        self._stop = QWaitCondition()
+
     data_updated = pyqtSignal(dict)
+    loading = pyqtSignal(str)
+
+    def load_initial_data(self):
+        if self.address_coords is None:
+            self.loading.emit("Locating address...")
+            self.address_coords = get_lat_long_from_string_address(
+                self.starting_address
+            )
+            print(
+                f"Converted supplied address to geo-coordinates\n{self.starting_address} -> {self.address_coords}"
+            )
+
+        if self.monitored_stop_list is None:
+            self.loading.emit("Finding nearby stops...")
+            search_radius_meters = int(os.getenv("SEARCH_RADIUS_METERS", "300"))
+            # Get locally served routes
+            route_list = get_nearby_routes(
+                self.transitland_api_key, self.address_coords
+            )
+            # route_list_detailed = {route['id']: get_route_details(key, route['id']) for route in route_list}
+
+            # Get locally served stops
+            self.monitored_stop_list = get_nearby_stops(
+                self.transitland_api_key, self.address_coords
+            )
+            print(
+                f"Within {search_radius_meters} meters of the provided address, there are "
+                f"{len(self.monitored_stop_list)} transit stops, served by {len(route_list)} routes."
+            )
+
+        self.loading.emit("Loading departures...")
+
+    def stop(self):
+        self._mutex.lock()
+        self._running = False
+        self._stop.wakeAll()
+        self._mutex.unlock()
+
+    def wait_for_next_update(self):
+        self._mutex.lock()
+        if self._running:
+            self._stop.wait(self._mutex, DISPLAY_UPDATE_INTERVAL_SEC * 1000)
+        self._mutex.unlock()
 
     def run(self):
-        while True:
+        # An exception escaping run() would end the thread silently, so keep retrying startup (e.g. network not up yet)
+        while self._running:
+            try:
+                self.load_initial_data()
+                break
+            except Exception as e:
+                print(f"unable to load initial data, retrying: {e}")
+                self.loading.emit(f"Unable to load transit data, retrying...\n{e}")
+                self.wait_for_next_update()
+
+        while self._running:
             # Get upcoming departure data in display ready format, get updated stops list we used for this data
             display_data, updated_stops_list = get_upcoming_departures(
                 self.transitland_api_key, self.monitored_stop_list, self.address_coords
             )
 
             # Update the monitored stops list to only the stops we used for the current data
-            if self.update_intervals_to_use_cached_stop_data != 0:
+            if datetime.now() < self.stops_cache_expiry:
                 self.monitored_stop_list = updated_stops_list
                 print(
                     f"currently monitoring {len(self.monitored_stop_list)} stops with {len(display_data)} departures"
                 )
                 print(
-                    f"{self.update_intervals_to_use_cached_stop_data} more updates "
-                    f"before we refresh monitored stop list"
+                    f"refreshing monitored stop list at {self.stops_cache_expiry:%H:%M:%S}"
                 )
-                self.update_intervals_to_use_cached_stop_data -= 1
             else:
                 # Refresh the stop list to start over from all nearby stops again to handle newly added routes etc.
                 print("refreshing all monitored stops (to handle newly added routes)")
                 self.monitored_stop_list = get_nearby_stops(
                     self.transitland_api_key, self.address_coords
                 )
-                self.update_intervals_to_use_cached_stop_data = (
-                    UPDATE_INTERVALS_TO_USE_CACHED_STOP_DATA
+                self.stops_cache_expiry = datetime.now() + timedelta(
+                    minutes=STOPS_CACHE_TTL_MIN
                 )
 
             # display_data = generate_randomized_data(num_routes=random.randint(11, 20), num_stops=random.randint(3, 9))
             print("done generating data, updating the UI")
             self.data_updated.emit(display_data)
 
-            self.msleep(DISPLAY_UPDATE_INTERVAL_SEC * 1000)
+            self.wait_for_next_update()
 
 
 class PageIndicator(QWidget):
@@ -97,42 +170,52 @@ class PageIndicator(QWidget):
 
         dot_radius = 5
         dot_spacing = 5
-        hollow_dot_color = QColor(255, 255, 255)
+        y = 0
+        inactive_dot_color = QColor(255, 255, 255, 100)
+        active_dot_color = QColor(255, 255, 255)
 
-        path = QPainterPath()
+        inactive_path = QPainterPath()
+        active_path = QPainterPath()
 
         for i in range(self.total_pages):
             x = i * (dot_radius * 2 + dot_spacing)
-            y = 0
-
-            painter.setBrush(hollow_dot_color)
-            painter.setPen(Qt.NoPen)
-            path.addEllipse(x, y, dot_radius * 2, dot_radius * 2)
-            painter.setBrush(hollow_dot_color)
-            path.addEllipse(x, y, dot_radius * 2, dot_radius * 2)
-
-        if self.total_pages > 0:
-            current_x = self.current_page * (dot_radius * 2 + dot_spacing)
-            painter.setBrush(hollow_dot_color)
-            path.addEllipse(current_x, y, dot_radius * 2, dot_radius * 2)
+            if i == self.current_page:
+                active_path.addEllipse(x, y, dot_radius * 2, dot_radius * 2)
+            else:
+                inactive_path.addEllipse(x, y, dot_radius * 2, dot_radius * 2)
 
-        painter.drawPath(path)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(inactive_dot_color)
+        painter.drawPath(inactive_path)
+        painter.setBrush(active_dot_color)
+        painter.drawPath(active_path)
 
 
 class BusStopApp(QWidget):
     def __init__(
         self,
         transitland_api_key: str,
-        monitored_stop_list: list[dict],
-        address_coords: tuple[float, float],
+        starting_address: str,
     ):
         super(BusStopApp, self).__init__()
 
         self.departure_info = {}
         self.current_page = 0
 
+        # Row widgets kept across updates, keyed by route headsign combo -> (row, stop label, times label)
+        self._row_widgets: dict[str, tuple[QWidget, QLabel, QLabel]] = {}
+        self._page_order: list[str] = None
+        # Window width the current rows' icon and font sizes were computed for
+        self._row_width: int = None
+
         self.stacked_widget = QStackedWidget(self)
 
+        # Placeholder page shown until the first departures arrive
+        self.loading_label = QLabel("Loading...")
+        self.loading_label.setAlignment(Qt.AlignCenter)
+        self.loading_label.setStyleSheet("color: white;")
+        self.stacked_widget.addWidget(self.loading_label)
+
         self.page_indicator = PageIndicator(total_pages=0)
         self.page_indicator.setFixedSize(100, 20)
 
@@ -140,14 +223,19 @@ class BusStopApp(QWidget):
         self.timer.timeout.connect(self.switch_page)
         self.timer.start(PAGE_TURN_INTERVAL_SEC * 1000)
 
-        self.signal_emitter = WorkerThread(
-            transitland_api_key, monitored_stop_list, address_coords
-        )
+        self.signal_emitter = WorkerThread(transitland_api_key, starting_address)
         self.signal_emitter.data_updated.connect(self.update_table)
+        self.signal_emitter.loading.connect(self.loading_label.setText)
         self.signal_emitter.start()
 
         self.setup_ui()
 
+    def closeEvent(self, event):
+        # Wake the worker out of its sleep so the app can exit right away
+        self.signal_emitter.stop()
+        self.signal_emitter.wait(5000)
+        super(BusStopApp, self).closeEvent(event)
+
     def setup_ui(self):
         layout = QVBoxLayout(self)
         layout.addWidget(self.stacked_widget)
@@ -171,8 +259,118 @@ class BusStopApp(QWidget):
 
     def update_table(self, display_data):
         self.departure_info = display_data
-        for i in reversed(range(self.stacked_widget.count())):
-            self.stacked_widget.removeWidget(self.stacked_widget.widget(i))
+
+        # Icon and font sizes follow the window width, so rebuild every row if it changed since they were made
+        if self.width() != self._row_width:
+            self._row_width = self.width()
+            stale_rows = set(self._row_widgets)
+            self._page_order = None
+        else:
+            # Otherwise only drop rows for departures that are no longer upcoming
+            stale_rows = set(self._row_widgets) - set(self.departure_info)
+
+        for route_headsign_combo in stale_rows:
+            row_widget, _, _ = self._row_widgets.pop(route_headsign_combo)
+            row_widget.deleteLater()
+
+        # Build rows only for new departures, existing rows just get their text refreshed
+        # All rows count down from the same moment so they agree with each other
+        now = datetime.now()
+        for route_headsign_combo, info in self.departure_info.items():
+            if route_headsign_combo not in self._row_widgets:
+                self._row_widgets[route_headsign_combo] = self.create_row(info)
+            _, label2, label3 = self._row_widgets[route_headsign_combo]
+
+            label2.setText(f"Closest Stop:\n{info.get('stop', '')}")
+
+            time_strings = time_difference_strings(
+                info.get("arrival_times", []), info.get("realtime_data", []), now=now
+            )
+            label_text3 = time_strings[0]
+            if len(time_strings) > 1:
+                label_text3 += f"\nalso {',  '.join(time_strings[1:])}"
+            label3.setText(label_text3)
+
+        # Only lay the pages out again when the departures shown (or their order) changed
+        if list(self.departure_info) != self._page_order:
+            self._page_order = list(self.departure_info)
+            self.layout_pages()
+
+    def create_row(self, info: dict) -> tuple[QWidget, QLabel, QLabel]:
+        row_widget = QWidget()
+
+        row_layout = QGridLayout(row_widget)
+
+        route_icon = QLabel()
+        route_icon.setStyleSheet(
+            "QLabel { background-color : transparent; color : white; }"
+        )
+        route_icon.setAlignment(Qt.AlignCenter)
+        route_icon_text = simplify_route_name(info.get("route", ""))
+
+        # Calculate the size dynamically based on the available space
+        icon_size = min(
+            self.width() // 20, row_widget.height()
+        )  # Adjust the denominator for desired scaling
+
+        # Calculate font size based on window width
+        font_size = self.width() // 60  # Adjust the denominator for desired scaling
+
+        font = QFont()
+        font.setPixelSize(font_size)
+
+        # Reuse the circular icon if this route was already drawn at this size
+        pixmap_key = f"ic:{route_icon_text}:{icon_size}:{font_size}"
+        pixmap = QPixmapCache.find(pixmap_key)
+        if pixmap is None:
+            # Paint the circle on a premultiplied QImage (fastest raster format) then convert it
+            image = QImage(icon_size, icon_size, QImage.Format_ARGB32_Premultiplied)
+            image.fill(Qt.transparent)
+            painter = QPainter(image)
+            painter.setRenderHint(QPainter.Antialiasing)
+            painter.setRenderHint(QPainter.TextAntialiasing)
+            random_color = QColor(*string_to_dark_background_color(route_icon_text))
+            painter.setBrush(random_color)
+            painter.drawEllipse(0, 0, icon_size, icon_size)
+            painter.setPen(Qt.white)
+            painter.setFont(font)
+            painter.drawText(
+                0, 0, icon_size, icon_size, Qt.AlignCenter, route_icon_text
+            )
+            painter.end()
+            pixmap = QPixmap.fromImage(image)
+            QPixmapCache.insert(pixmap_key, pixmap)
+
+        route_icon.setPixmap(pixmap)
+        route_icon.setFixedSize(icon_size, icon_size)
+
+        label_text = f"{info.get('agency_name', '')} {info.get('route_type', '')}\nto {info.get('direction', '')}"
+        label = QLabel(label_text)
+        label.setAlignment(Qt.AlignLeft)
+        label.setStyleSheet("color: white;")
+        label.setFont(font)
+
+        label2 = QLabel()
+        label2.setAlignment(Qt.AlignLeft)
+        label2.setStyleSheet("color: white;")
+        label2.setFont(font)
+
+        label3 = QLabel()
+        label3.setAlignment(Qt.AlignLeft)
+        label3.setStyleSheet("color: white;")
+        label3.setFont(font)
+
+        row_layout.addWidget(route_icon, 0, 0)
+        row_layout.addWidget(label, 0, 1)
+        row_layout.addWidget(label2, 0, 2)
+        row_layout.addWidget(label3, 0, 3)
+
+        return row_widget, label2, label3
+
+    def layout_pages(self):
+        old_pages = [
+            self.stacked_widget.widget(i) for i in range(self.stacked_widget.count())
+        ]
 
         items_per_page = 4
         total_departures = len(self.departure_info)
@@ -181,6 +379,7 @@ class BusStopApp(QWidget):
         self.page_indicator.total_pages = total_pages
         self.page_indicator.set_current_page(self.current_page)
 
+        departure_items = list(self.departure_info.items())
         for page in range(total_pages):
             start_index = page * items_per_page
             end_index = min((page + 1) * items_per_page, total_departures)
@@ -188,93 +387,17 @@ class BusStopApp(QWidget):
             page_widget = QWidget()
             layout = QVBoxLayout(page_widget)
 
-            for route_headsign_combo, info in list(self.departure_info.items())[
-                start_index:end_index
-            ]:
-                row_widget = QWidget()
-
-                row_layout = QGridLayout(row_widget)
-
-                route_icon = QLabel()
-                route_icon.setStyleSheet(
-                    "QLabel { background-color : transparent; color : white; }"
-                )
-                route_icon.setAlignment(Qt.AlignCenter)
-                route_icon_text = simplify_route_name(info.get("route", ""))
-
-                # Calculate the size dynamically based on the available space
-                icon_size = min(
-                    self.width() // 20, row_widget.height()
-                )  # Adjust the denominator for desired scaling
-
-                # Create a circular QPixmap
-                pixmap = QPixmap(icon_size, icon_size)
-                pixmap.fill(Qt.transparent)
-                painter = QPainter(pixmap)
-                painter.setRenderHint(QPainter.Antialiasing)
-                random_color = QColor(*string_to_dark_background_color(route_icon_text))
-                painter.setBrush(random_color)
-                painter.drawEllipse(0, 0, icon_size, icon_size)
-                painter.setPen(Qt.white)
-
-                # Calculate font size based on window width
-                font_size = (
-                    self.width() // 60
-                )  # Adjust the denominator for desired scaling
-
-                font = QFont()
-                font.setPixelSize(font_size)
-
-                painter.setFont(font)
-                painter.drawText(
-                    0, 0, icon_size, icon_size, Qt.AlignCenter, route_icon_text
-                )
-                painter.end()
-
-                route_icon.setPixmap(pixmap)
-                route_icon.setFixedSize(icon_size, icon_size)
-
-                label_text = f"{info.get('agency_name', '')} {info.get('route_type', '')}\nto {info.get('direction', '')}"
-                label = QLabel(label_text)
-                label.setAlignment(Qt.AlignLeft)
-                label.setStyleSheet("color: white;")
-                label.setFont(font)
-
-                label_text2 = f"Closest Stop:\n{info.get('stop', '')}"
-                label2 = QLabel(label_text2)
-                label2.setAlignment(Qt.AlignLeft)
-                label2.setStyleSheet("color: white;")
-                label2.setFont(font)
-
-                label_text3 = f"{time_difference_strings(info.get('arrival_times', []), info.get('realtime_data', []))[0]}"
-                if (
-                    len(
-                        time_difference_strings(
-                            info.get("arrival_times", []), info.get("realtime_data", [])
-                        )
-                    )
-                    > 1
-                ):
-                    label_text3 += (
-                        "\nalso"
-                        f" {',  '.join(time_difference_strings(info.get('arrival_times', []), info.get('realtime_data', []))[1:])}"
-                    )
-
-                label3 = QLabel(label_text3)
-                label3.setAlignment(Qt.AlignLeft)
-                label3.setStyleSheet("color: white;")
-                label3.setFont(font)
-
-                row_layout.addWidget(route_icon, 0, 0)
-                row_layout.addWidget(label, 0, 1)
-                row_layout.addWidget(label2, 0, 2)
-                row_layout.addWidget(label3, 0, 3)
-
-                layout.addWidget(row_widget)
+            # Adding the existing row widgets to the new page re-parents them off the old pages
+            for route_headsign_combo, _ in departure_items[start_index:end_index]:
+                layout.addWidget(self._row_widgets[route_headsign_combo][0])
 
             page_widget.setLayout(layout)
             self.stacked_widget.addWidget(page_widget)
 
+        for page_widget in old_pages:
+            self.stacked_widget.removeWidget(page_widget)
+            page_widget.deleteLater()
+
         self.current_page = 0
         self.stacked_widget.setCurrentIndex(self.current_page)
         self.page_indicator.set_current_page(self.current_page)
@@ -292,29 +415,12 @@ if __name__ == "__main__":
         sys.exit(1)
 
     starting_address = os.getenv("STARTING_ADDRESS", "3401 Market St Philadelphia")
-    search_radius_meters = int(os.getenv("SEARCH_RADIUS_METERS", "300"))
-
-    # Initial setup/data gathering
-    address_lat_long = get_lat_long_from_string_address(starting_address)
-    print(
-        f"Converted supplied address to geo-coordinates\n{starting_address} -> {address_lat_long}"
-    )
-    # Get locally served routes
-    route_list = get_nearby_routes(transitland_api_key, address_lat_long)
-    # route_list_detailed = {route['id']: get_route_details(key, route['id']) for route in route_list}
-
-    # Get locally served stops
-    stop_list = get_nearby_stops(transitland_api_key, address_lat_long)
-    print(
-        f"Within {search_radius_meters} meters of the provided address, there are {len(stop_list)} "
-        f"transit stops, served by {len(route_list)} routes."
-    )
 
+    # Address lookup and nearby stop gathering happen on the worker thread after the window is up
     app = QApplication(sys.argv)
     window = BusStopApp(
         transitland_api_key=transitland_api_key,
-        monitored_stop_list=stop_list,
-        address_coords=address_lat_long,
+        starting_address=starting_address,
     )
     window.show()
     sys.exit(app.exec_())
@@ -2,27 +2,78 @@ import json
 import os
 import random
 import string
-import hashlib
+import zlib
+import functools
 from datetime import datetime, timedelta
 
 import backoff
+import orjson
 import requests
 from requests import RequestException
+from requests.adapters import HTTPAdapter
 from math import radians, sin, cos, sqrt, atan2
 
+# Failures worth retrying, orjson decode errors are plain ValueErrors so a bad body (e.g. a proxy page) is listed too
+RETRYABLE_EXCEPTIONS = (RequestException, orjson.JSONDecodeError)
+
+# (connect, read) timeout in seconds for all outbound API calls
+REQUEST_TIMEOUT_SEC = (5, 30)
+
+# Shared session so repeated calls reuse pooled keep-alive connections instead of a new TLS handshake each time
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://", HTTPAdapter(pool_connections=2, pool_maxsize=32, pool_block=False)
+)
+
+
+class GraphQLQueryError(RequestException):
+    """Raised when a Transitland GraphQL query returns errors or no data"""
+
+
+# Departure fields read when merging and displaying, fetched for many stops in one GraphQL query
+STOP_DEPARTURES_QUERY = """
+query ($stop_ids: [Int!], $next_sec: Int) {
+  stops(ids: $stop_ids) {
+    id
+    departures(where: {next: $next_sec}) {
+      service_date
+      arrival_time
+      arrival {
+        estimated
+        scheduled
+      }
+      trip {
+        id
+        trip_headsign
+        route {
+          route_short_name
+          route_type
+          agency {
+            agency_name
+          }
+        }
+      }
+    }
+  }
+}
+"""
 
-def string_to_dark_background_color(input_string: str) -> tuple[int, int, int]:
-    # Use hashlib to generate a hash based on the input string
-    hash_object = hashlib.md5(input_string.encode())
-    hash_hex = hash_object.hexdigest()
+# On-disk cache of geocoded addresses, addresses don't move so entries live a long time
+GEOCODE_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "mini_metro_display", "geocode.json"
+)
+GEOCODE_CACHE_TTL = timedelta(days=30)
 
-    # Take the first 6 characters of the hash to get an RGB value
-    hex_color = hash_hex[:6]
 
-    # Convert hex to RGB and ensure darker shades
-    red = int(hex_color[0:2], 16) % 128
-    green = int(hex_color[2:4], 16) % 128
-    blue = int(hex_color[4:6], 16) % 128
+@functools.lru_cache(maxsize=256)
+def string_to_dark_background_color(input_string: str) -> tuple[int, int, int]:
+    # A cheap non-cryptographic hash is plenty to pick a stable color for the string
+    hash_value = zlib.crc32(input_string.encode())
+
+    # Take the low 3 bytes of the hash as RGB and ensure darker shades
+    red = hash_value & 0x7F
+    green = (hash_value >> 8) & 0x7F
+    blue = (hash_value >> 16) & 0x7F
 
     return red, green, blue
 
@@ -46,14 +97,49 @@ def haversine(lat1, lon1, lat2, lon2):
     return distance
 
 
+def load_geocode_cache() -> dict:
+    try:
+        with open(GEOCODE_CACHE_PATH, "r", encoding="utf-8") as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+    # Anything other than an address -> entry mapping is treated as an empty cache
+    return cache if isinstance(cache, dict) else {}
+
+
+def save_geocode_cache(cache: dict):
+    try:
+        os.makedirs(os.path.dirname(GEOCODE_CACHE_PATH), exist_ok=True)
+        # Write to a temp file first and swap it in so a crash never leaves a half written cache
+        temp_path = f"{GEOCODE_CACHE_PATH}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as cache_file:
+            json.dump(cache, cache_file)
+        os.replace(temp_path, GEOCODE_CACHE_PATH)
+    except OSError as e:
+        print(f"Unable to write geocode cache: {e}")
+
+
 def get_lat_long_from_string_address(address: str) -> tuple[float, float]:
+    cache_key = " ".join(address.lower().split())
+    cache = load_geocode_cache()
+    cached_entry = cache.get(cache_key)
+    try:
+        cached_at = datetime.fromtimestamp(cached_entry["timestamp"])
+        if datetime.now() - cached_at < GEOCODE_CACHE_TTL:
+            return float(cached_entry["lat"]), float(cached_entry["lon"])
+    except (TypeError, KeyError, ValueError, OverflowError, OSError):
+        # Missing or malformed entry, treat it as a cache miss and look the address up again
+        pass
+
     nominatim_endpoint = "https://nominatim.openstreetmap.org/search"
     params = {
         "format": "json",
         "q": address,
     }
-    response = requests.get(nominatim_endpoint, params=params)
-    data = response.json()
+    response = _SESSION.get(
+        nominatim_endpoint, params=params, timeout=REQUEST_TIMEOUT_SEC
+    )
+    data = orjson.loads(response.content)
 
     if not data:
         print("No location found for the given address.")
@@ -61,10 +147,17 @@ def get_lat_long_from_string_address(address: str) -> tuple[float, float]:
 
     # Assuming the first result is the desired location
     location = data[0]
-    return float(location["lat"]), float(location["lon"])
+    lat, lon = float(location["lat"]), float(location["lon"])
+
+    cache[cache_key] = {"lat": lat, "lon": lon, "timestamp": datetime.now().timestamp()}
+    save_geocode_cache(cache)
+
+    return lat, lon
 
 
-@backoff.on_exception(backoff.expo, RequestException, jitter=backoff.full_jitter)
+@backoff.on_exception(
+    backoff.expo, RETRYABLE_EXCEPTIONS, jitter=backoff.full_jitter
+)
 def get_nearby_routes(api_key: str, lat_long: tuple[float, float]) -> list:
     search_radius_meters = int(os.getenv("SEARCH_RADIUS_METERS", "300"))
     params = {
@@ -72,20 +165,26 @@ def get_nearby_routes(api_key: str, lat_long: tuple[float, float]) -> list:
         "lon": lat_long[1],
         "radius": search_radius_meters,  # Radius in meters (adjust as needed),
         "limit": 100,
+        "include_geometry": "false",  # Route shapes are large and never used
     }
     transitland_endpoint = "https://transit.land/api/v2/rest/routes"
-    response = requests.get(
-        transitland_endpoint, params=params, headers={"apikey": api_key}
+    response = _SESSION.get(
+        transitland_endpoint,
+        params=params,
+        headers={"apikey": api_key},
+        timeout=REQUEST_TIMEOUT_SEC,
     )
     print(response)
     response.raise_for_status()
-    json_data = response.json()
+    json_data = orjson.loads(response.content)
     if not json_data:
         return []
     return json_data["routes"]
 
 
-@backoff.on_exception(backoff.expo, RequestException, jitter=backoff.full_jitter)
+@backoff.on_exception(
+    backoff.expo, RETRYABLE_EXCEPTIONS, jitter=backoff.full_jitter
+)
 def get_nearby_stops(api_key: str, lat_long: tuple[float, float]) -> list:
     search_radius_meters = int(os.getenv("SEARCH_RADIUS_METERS", "300"))
     params = {
@@ -95,16 +194,20 @@ def get_nearby_stops(api_key: str, lat_long: tuple[float, float]) -> list:
         "limit": 100,
     }
     transitland_endpoint = "https://transit.land/api/v2/rest/stops"
-    response = requests.get(
-        transitland_endpoint, params=params, headers={"apikey": api_key}
+    response = _SESSION.get(
+        transitland_endpoint,
+        params=params,
+        headers={"apikey": api_key},
+        timeout=REQUEST_TIMEOUT_SEC,
     )
     response.raise_for_status()
-    json_data = response.json()
+    json_data = orjson.loads(response.content)
     if not json_data:
         return []
     return json_data["stops"]
 
 
+@functools.lru_cache(maxsize=4096)
 def get_corrected_datetime(service_date: str, arrival_time: str) -> datetime:
     # Parsing the service_date
     arrival_date = datetime.strptime(service_date, "%Y-%m-%d")
@@ -123,21 +226,35 @@ def get_corrected_datetime(service_date: str, arrival_time: str) -> datetime:
     return arrival_date.replace(hour=hour, minute=minute, second=second)
 
 
-@backoff.on_exception(backoff.expo, RequestException, jitter=backoff.full_jitter)
-def get_departures_for_stop_id(
-    api_key: str, stop_id: str, next_sec: int = None
-) -> list:
-    print(f"getting upcoming departures for: {stop_id}")
-    transitland_endpoint = (
-        f"https://transit.land/api/v2/rest/stops/{stop_id}/departures"
-    )
-    params = {"next": 86400 if not next_sec else next_sec}  # TODO?
-    response = requests.get(
-        transitland_endpoint, params=params, headers={"apikey": api_key}
+@backoff.on_exception(
+    backoff.expo, RETRYABLE_EXCEPTIONS, jitter=backoff.full_jitter
+)
+def get_departures_for_stop_ids(
+    api_key: str, stop_ids: list[int], next_sec: int = None
+) -> dict[int, list]:
+    print(f"getting upcoming departures for {len(stop_ids)} stops")
+    transitland_endpoint = "https://transit.land/api/v2/query"
+    payload = {
+        "query": STOP_DEPARTURES_QUERY,
+        "variables": {
+            "stop_ids": stop_ids,
+            "next_sec": 86400 if not next_sec else next_sec,
+        },
+    }
+    response = _SESSION.post(
+        transitland_endpoint,
+        json=payload,
+        headers={"apikey": api_key},
+        timeout=REQUEST_TIMEOUT_SEC,
     )
-    # print(response)
     response.raise_for_status()
-    return response.json()["stops"][0]["departures"]
+    json_data = orjson.loads(response.content)
+    # GraphQL reports query errors with a 200 status, raise them so backoff retries like any failed request
+    if json_data.get("errors") or not json_data.get("data"):
+        raise GraphQLQueryError(
+            f"departures query failed: {json_data.get('errors')}", response=response
+        )
+    return {stop["id"]: stop["departures"] for stop in json_data["data"]["stops"]}
 
 
 def get_next_departures_for_stop_list(
@@ -147,17 +264,24 @@ def get_next_departures_for_stop_list(
     hours: int = 1,
 ) -> dict:
     departures = {}
+    if not stops:
+        return departures
+
+    # Fetch departures for every stop in a single request, then merge in stop order
+    departures_by_stop_id = get_departures_for_stop_ids(
+        api_key, [stop["id"] for stop in stops], next_sec=(3600 * hours)
+    )
 
     for stop in stops:
-        departures_for_stop = get_departures_for_stop_id(
-            api_key, stop["id"], next_sec=(3600 * hours)
+        departures_for_stop = departures_by_stop_id.get(stop["id"], [])
+        # Distance only depends on the stop, so compute it once rather than per departure
+        stop_point = stop["geometry"]["coordinates"]
+        user_distance_from_stop = haversine(
+            starting_coords[0], starting_coords[1], stop_point[1], stop_point[0]
         )
+
         for stop_departure in departures_for_stop:
             trip_id = stop_departure["trip"]["id"]
-            stop_point = stop["geometry"]["coordinates"]
-            user_distance_from_stop = haversine(
-                starting_coords[0], starting_coords[1], stop_point[1], stop_point[0]
-            )
 
             realtime_arrival_time = stop_departure["arrival"]["estimated"]
             scheduled_arrival_time = stop_departure["arrival"]["scheduled"]
@@ -168,7 +292,7 @@ def get_next_departures_for_stop_list(
                 realtime_data = False
                 arrival_time = scheduled_arrival_time
 
-            if trip_id not in departures.keys():
+            if trip_id not in departures:
                 arrival_datetime = get_corrected_datetime(
                     stop_departure["service_date"], arrival_time
                 )
@@ -195,9 +319,8 @@ def get_next_departures_for_stop_list(
                 if user_distance_from_stop < current_distance_from_cached_stop:
                     print("It is closer, updating cache")
 
-                    arrival_datetime = datetime.strptime(
-                        f"{stop_departure['service_date']} {arrival_time}",
-                        "%Y-%m-%d %H:%M:%S",
+                    arrival_datetime = get_corrected_datetime(
+                        stop_departure["service_date"], arrival_time
                     )
                     departures[trip_id] = {
                         "departure": stop_departure,
@@ -218,8 +341,9 @@ def print_schedule(display: dict):
     print(json.dumps(display, default=str, indent=1))
 
 
-def time_difference_strings(date_list, realtime_data=None):
-    current_time = datetime.now()
+def time_difference_strings(date_list, realtime_data=None, now=None):
+    # Arrival times are naive local datetimes, so the anchor time is too
+    current_time = now if now is not None else datetime.now()
 
     time_strings = []
 
@@ -240,28 +364,6 @@ def time_difference_strings(date_list, realtime_data=None):
     return time_strings
 
 
-def time_difference_strings(date_list, realtime_data=None):
-    current_time = datetime.now()
-
-    time_strings = []
-
-    for date_index, date in enumerate(date_list):
-        time_difference = date - current_time
-        minutes_difference = int(time_difference.total_seconds() / 60)
-
-        if minutes_difference == 0:
-            time_string_to_add = "Now"
-        else:
-            time_string_to_add = f"{abs(minutes_difference)} min"
-
-        if realtime_data and realtime_data[date_index]:
-            time_string_to_add = f"{time_string_to_add}📡"
-
-        time_strings.append(time_string_to_add)
-
-    return time_strings
-
-
 def generate_random_string(length=8):
     characters = string.ascii_letters + string.digits
     random_string = "".join(random.choice(characters) for _ in range(length))
@@ -305,12 +407,12 @@ def get_upcoming_departures(
     all_departures = get_next_departures_for_stop_list(
         api_key, stop_list, address_geo_coords
     )
-    sorted_departures = dict(
-        sorted(all_departures.items(), key=lambda item: item[1]["arrival_time"])
+    sorted_departures = sorted(
+        all_departures.items(), key=lambda item: item[1]["arrival_time"]
     )
 
     departure_dict = {}
-    for trip_id, trip_vals in sorted_departures.items():
+    for trip_id, trip_vals in sorted_departures:
         # Parse out values from the sorted departure for use in the UI list
         departure = trip_vals["departure"]
         agency_name = departure["trip"]["route"]["agency"]["agency_name"]
@@ -330,7 +432,7 @@ def get_upcoming_departures(
         )
 
         # Store entry under headsign combo key
-        if route_headsign_combo not in departure_dict.keys():
+        if route_headsign_combo not in departure_dict:
             departure_dict[route_headsign_combo] = {
                 "route": departure["trip"]["route"]["route_short_name"],
                 "route_type": gtfs_route_type_to_string(
@@ -356,11 +458,11 @@ def get_upcoming_departures(
 
     # List to store only stops worth monitoring (closest to location for a given route + direction combo)
     updated_stop_list = []
+    seen_stop_ids = set()
     for _, departure_values in departure_dict.items():
-        if not any(
-            stop_list_entry["id"] == departure_values["full_stop"]["id"]
-            for stop_list_entry in updated_stop_list
-        ):
+        stop_id = departure_values["full_stop"]["id"]
+        if stop_id not in seen_stop_ids:
+            seen_stop_ids.add(stop_id)
             updated_stop_list.append(departure_values["full_stop"])
 
     return departure_dict, updated_stop_list
@@ -398,6 +500,7 @@ def gtfs_route_type_to_string(route_type_int: int) -> str:
     return route_type_to_string_mapping[route_type_int]
 
 
+@functools.lru_cache(maxsize=256)
 def simplify_route_name(route_name: str) -> str:
     route_name = route_name.replace(" Line", "")
     route_name = route_name.replace("/", "\n")